@@ -13,14 +13,21 @@
 # limitations under the License.
 
 
+import collections
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+import contextlib
 import logging
-from typing import List
+import queue
+from typing import Any, Callable, Dict, List, Optional, Tuple
 import threading
 import time
 import string
-import random
+import secrets
 
 import boto3
+import botocore.session
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
 from tests.config import settings
 from tests.lib.hardware.hardware_base import HardwareBase
@@ -31,12 +38,240 @@ from tests.lib.workspace import Workspace
 logger = logging.getLogger(__name__)
 
 
+def _name_tag_specifications(resource_type: str, name: str):
+    # Tag a resource as part of the call creating it instead of issuing a
+    # separate CreateTags call afterwards
+    return [{
+        "ResourceType": resource_type,
+        "Tags": [{"Key": "Name", "Value": name}],
+    }]
+
+
+@contextlib.contextmanager
+def _delete_on_failure(resource):
+    # Delete a freshly created resource if setting it up any further fails,
+    # nothing else knows about it yet
+    try:
+        yield
+    except Exception:
+        try:
+            resource.delete()
+        except Exception:
+            logger.exception("Unable to delete %s", resource)
+        raise
+
+
+def _check_instance_alive(data: Dict[str, Any]):
+    # same failure states as the instance_running waiter of boto3
+    state = data['State']['Name']
+    if state in ("shutting-down", "terminated", "stopping"):
+        raise Exception(f"Instance {data['InstanceId']} is {state}")
+
+
+def _instance_running(data: Dict[str, Any]) -> bool:
+    _check_instance_alive(data)
+    return data['State']['Name'] == "running"
+
+
+def _instance_has_public_ip(data: Dict[str, Any]) -> bool:
+    _check_instance_alive(data)
+    return data.get('PublicIpAddress') is not None
+
+
+class _InstanceWatch:
+    def __init__(self, condition: Callable[[Dict[str, Any]], bool]):
+        self.condition = condition
+        self.event = threading.Event()
+        self.data: Optional[Dict[str, Any]] = None
+        # last error seen while describing the instance, or the error raised
+        # by the condition (which ends the watch)
+        self.error: Optional[Exception] = None
+
+
+class InstanceDescribeBatcher:
+    """
+    Coalesce DescribeInstances calls issued by concurrently booting nodes
+
+    Lookups submitted within max_delay seconds of the first pending one are
+    answered by a single DescribeInstances call covering all of them.
+    Instances somebody waits on (see wait_until()) are described along with
+    them every poll_interval seconds until their condition holds.
+    """
+    def __init__(self, client, max_delay: float = 0.3,
+                 poll_interval: float = 3, describe_timeout: float = 300):
+        self._client = client
+        self._max_delay = max_delay
+        self._poll_interval = poll_interval
+        self._describe_timeout = describe_timeout
+        self._lock = threading.Lock()
+        self._pending: Dict[str, List[queue.Queue]] = {}
+        self._watches: Dict[str, List[_InstanceWatch]] = {}
+        self._timer: Optional[threading.Timer] = None
+        self._deadline = 0.0
+
+    def describe(self, instance_id: str) -> Dict[str, Any]:
+        """
+        Return the DescribeInstances data for the given instance
+        """
+        result: queue.Queue = queue.Queue()
+        with self._lock:
+            self._pending.setdefault(instance_id, []).append(result)
+            self._schedule(self._max_delay)
+        try:
+            data = result.get(timeout=self._describe_timeout)
+        except queue.Empty:
+            with self._lock:
+                if result in self._pending.get(instance_id, []):
+                    self._pending[instance_id].remove(result)
+                    if not self._pending[instance_id]:
+                        del self._pending[instance_id]
+            raise Exception(f"Timed out describing instance {instance_id}")
+        if isinstance(data, Exception):
+            raise data
+        return data
+
+    def wait_until(self, instance_id: str,
+                   condition: Callable[[Dict[str, Any]], bool],
+                   timeout: float) -> Dict[str, Any]:
+        """
+        Wait until condition() is true for the DescribeInstances data of the
+        given instance and return that data
+
+        condition() may raise to give up waiting (eg. because the instance is
+        being terminated).
+        """
+        watch = _InstanceWatch(condition)
+        with self._lock:
+            self._watches.setdefault(instance_id, []).append(watch)
+            self._schedule(self._max_delay)
+        if not watch.event.wait(timeout):
+            with self._lock:
+                if watch in self._watches.get(instance_id, []):
+                    self._watches[instance_id].remove(watch)
+                    if not self._watches[instance_id]:
+                        del self._watches[instance_id]
+            if not watch.event.is_set():
+                message = f"Timed out waiting for instance {instance_id}"
+                if watch.error is not None:
+                    message += f" (last error: {watch.error})"
+                raise Exception(message)
+        if watch.data is None:
+            assert watch.error is not None
+            raise watch.error
+        return watch.data
+
+    def _schedule(self, delay: float):
+        # must be called with self._lock held. A pending call is moved
+        # forward if needed, so lookups are not held back by the (longer)
+        # poll interval of the watches.
+        deadline = time.monotonic() + delay
+        if self._timer is not None:
+            if self._deadline <= deadline:
+                return
+            self._timer.cancel()
+        self._deadline = deadline
+        self._timer = threading.Timer(delay, self._flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _describe_instances(self, instance_ids: List[str]) -> Dict[str, Any]:
+        """
+        Map each of the given instance ids to its DescribeInstances data or to
+        the exception raised while describing it
+        """
+        try:
+            response = self._client.describe_instances(
+                InstanceIds=instance_ids)
+        except Exception as e:
+            unknown_instance = (
+                isinstance(e, ClientError) and
+                e.response.get('Error', {}).get('Code', '').startswith(
+                    'InvalidInstanceID.')
+            )
+            if len(instance_ids) == 1 or not unknown_instance:
+                # eg. throttling or network errors, describing the instances
+                # one by one would only make those worse
+                return {instance_id: e for instance_id in instance_ids}
+            # A single unknown instance (eg. one not visible yet due to EC2's
+            # eventual consistency) fails the whole call, so describe the
+            # instances one by one to only fail the offending one.
+            results: Dict[str, Any] = {}
+            for instance_id in instance_ids:
+                results.update(self._describe_instances([instance_id]))
+            return results
+
+        results = {
+            instance_id: Exception(f"Instance {instance_id} not found")
+            for instance_id in instance_ids
+        }
+        for reservation in response['Reservations']:
+            for instance in reservation['Instances']:
+                results[instance['InstanceId']] = instance
+        return results
+
+    def _flush(self):
+        with self._lock:
+            # a timer which got moved forward might still fire, it must not
+            # forget about its replacement
+            if self._timer is threading.current_thread():
+                self._timer = None
+            pending = self._pending
+            self._pending = {}
+            instance_ids = sorted(set(pending) | set(self._watches))
+        if not instance_ids:
+            return
+
+        try:
+            results = self._describe_instances(instance_ids)
+        except Exception as e:
+            # eg. an unexpected response, never leave the callers hanging
+            results = {instance_id: e for instance_id in instance_ids}
+
+        for instance_id, queues in pending.items():
+            for result in queues:
+                result.put(results[instance_id])
+
+        with self._lock:
+            for instance_id in list(self._watches):
+                data = results.get(instance_id)
+                if data is None:
+                    # the watch was added after the instances were described
+                    continue
+                if isinstance(data, Exception):
+                    # the error might be transient, so keep polling until the
+                    # watches time out
+                    for watch in self._watches[instance_id]:
+                        watch.error = data
+                    continue
+                waiting = []
+                for watch in self._watches[instance_id]:
+                    try:
+                        done = watch.condition(data)
+                    except Exception as e:
+                        watch.error = e
+                        watch.event.set()
+                        continue
+                    if done:
+                        watch.data = data
+                        watch.event.set()
+                    else:
+                        waiting.append(watch)
+                if waiting:
+                    self._watches[instance_id] = waiting
+                else:
+                    del self._watches[instance_id]
+            if self._watches:
+                self._schedule(self._poll_interval)
+
+
 class Node(NodeBase):
     def __init__(self, name: str, role: NodeRole, tags: List[str],
                  ec2: boto3.resources.base.ServiceResource,
                  subnet: boto3.resources.base.ServiceResource,
                  security_group: boto3.resources.base.ServiceResource,
-                 keypair: boto3.resources.base.ServiceResource):
+                 keypair: boto3.resources.base.ServiceResource,
+                 batcher: InstanceDescribeBatcher,
+                 instance: boto3.resources.base.ServiceResource):
         super().__init__(name, role, tags)
         self._name = name
         self._role = role
@@ -45,81 +280,134 @@ class Node(NodeBase):
         self._subnet = subnet
         self._security_group = security_group
         self._keypair = keypair
-        self._instance = None
+        self._batcher = batcher
+        self._instance = instance
+        self._availability_zone: Optional[str] = None
+        # volume id -> disk name, mirrors self._disks
+        self._disks_by_vol_id: Dict[str, str] = {}
+        # device names available for data disks, /dev/xvda is reserved for
+        # the root device. Names are handed out from the right (xvdb first).
+        self._device_pool = collections.deque(
+            f"/dev/xvd{c}" for c in string.ascii_lowercase[:0:-1])
+        # block device mappings only change when this node attaches or
+        # detaches a disk, so they are cached until then
+        self._bdm_cache: Optional[List[Dict[str, Any]]] = None
+        self._bdm_valid = False
+
+    def _reload_instance(self):
+        # Same as self._instance.reload() but the DescribeInstances call is
+        # shared with the other nodes of the hardware
+        self._instance.meta.data = self._batcher.describe(self._instance.id)
+
+    def _get_block_device_mappings(self) -> List[Dict[str, Any]]:
+        if not self._bdm_valid:
+            self._reload_instance()
+            self._bdm_cache = list(self._instance.block_device_mappings or [])
+            self._bdm_valid = True
+        assert self._bdm_cache is not None
+        return self._bdm_cache
+
+    def _wait_for_instance(self, condition, timeout: float):
+        # Let the batcher poll the instance together with the other nodes
+        # and wake us up once the condition holds
+        self._instance.meta.data = self._batcher.wait_until(
+            self._instance.id, condition, timeout)
+
+    def _wait_until_running(self):
+        if self._instance.state['Name'] == "running":
+            return
+        self._wait_for_instance(_instance_running, timeout=600)
 
     def boot(self):
-        instances = self._ec2.create_instances(
-            ImageId=settings.AWS.AMI_IMAGE_ID,
-            InstanceType=settings.AWS.NODE_SIZE,
-            MinCount=1,
-            MaxCount=1,
-            SecurityGroupIds=[
-                self._security_group.id,
-            ],
-            KeyName=self._keypair.name,
-            SubnetId=self._subnet.id,
-        )
-
-        self._instance = instances[0]
-        self._instance.create_tags(
-            Tags=[{"Key": "Name", "Value": self._name}])
+        # the instance itself is launched by the Hardware (possibly together
+        # with other nodes), so only the per node setup is done here. Instances
+        # launched in a batch share their tags, so they are named afterwards.
+        if not any(tag['Key'] == "Name" for tag in self._instance.tags or []):
+            self._instance.create_tags(
+                Tags=[{"Key": "Name", "Value": self._name}])
         self._instance.wait_until_exists()
+        # the availability zone of an instance never changes
+        self._availability_zone = self._instance.placement['AvailabilityZone']
 
-        logger.info(f"Created Node {self._instance}")
+        logger.info("Created Node %s", self._instance.id)
 
         if self._role == NodeRole.WORKER:
-            for i in range(0, settings.WORKER_INITIAL_DATA_DISKS):
-                disk_name = self.disk_create(10)
-                self.disk_attach(name=disk_name)
+            self._create_initial_disks()
+
+    def _create_initial_disks(self):
+        count = settings.WORKER_INITIAL_DATA_DISKS
+        if count <= 0:
+            return
+        # create the volumes concurrently and wait for all of them at once
+        with ThreadPoolExecutor(max_workers=count) as executor:
+            futures = [
+                executor.submit(self._create_volume, 10)
+                for _ in range(0, count)
+            ]
+        # register every volume that got created before raising any error,
+        # so that destroy() removes them
+        disk_names = [
+            self._add_disk(*future.result())
+            for future in futures if future.exception() is None
+        ]
+        for future in futures:
+            future.result()
+        self._ec2.meta.client.get_waiter('volume_available').wait(
+            VolumeIds=[self._disks[n]['volume'].id for n in disk_names],
+            WaiterConfig={"Delay": 5, "MaxAttempts": 20},
+        )
+        for disk_name in disk_names:
+            self.disk_attach(name=disk_name)
 
     def get_ssh_ip(self) -> str:
-        if not self._instance:
-            return ""
-        # The IP address may not be ready immediately. If that's the case,
-        # try reloading the instance information a reasonable number of times.
-        attempts = 60
-        while self._instance.public_ip_address is None:
-            time.sleep(3)
-            self._instance.reload()
-            attempts -= 1
-            if attempts <= 0:
-                raise Exception(
-                    f"Unable to get public IP for instance {self._instance}")
+        if self._instance.public_ip_address is None:
+            # The public IP address is assigned once the instance is running
+            # (the subnet maps public IPs on launch)
+            self._wait_for_instance(_instance_has_public_ip, timeout=200)
         return self._instance.public_ip_address
 
     def _get_vol_name_by_vol(self, volume):
-        for k, v in self._disks.items():
-            if v['volume'].id == volume.id:
-                return k
+        return self._disks_by_vol_id[volume.id]
 
     def disk_create(self, capacity):
+        return self._add_disk(*self._create_volume(capacity))
+
+    def _create_volume(self, capacity) -> Tuple[str, str]:
+        # Only uses the (thread-safe) client, so volumes can be created
+        # concurrently. Returns the disk name and the volume id.
         super().disk_create(capacity)
-        if not self._instance:
-            raise Exception("Can not create a disk until a node is created")
-        suffix = ''.join(random.choice(string.ascii_lowercase)
-                         for i in range(5))
+        if self._availability_zone is None:
+            raise Exception("Can not create a disk until the node is booted")
+        suffix = secrets.token_hex(3)[:5]
         name = f"{self._name}-volume-{suffix}"
-        volume = self._ec2.create_volume(
-            AvailabilityZone=self._instance.placement['AvailabilityZone'],
+        response = self._ec2.meta.client.create_volume(
+            AvailabilityZone=self._availability_zone,
             Size=capacity,
+            TagSpecifications=_name_tag_specifications("volume", name),
         )
-        volume.create_tags(
-            Tags=[{"Key": "Name", "Value": name}])
+        return name, response['VolumeId']
+
+    def _add_disk(self, name: str, volume_id: str) -> str:
+        volume = self._ec2.Volume(volume_id)
         self._disks[name] = {'volume': volume, 'attached': False}
-        logger.info(f"disk {name} ({volume}) created")
+        self._disks_by_vol_id[volume_id] = name
+        logger.info("disk %s (%s) created", name, volume_id)
         return name
 
     def _get_next_device_name(self):
-        if not self._instance:
-            return None
-        self._instance.reload()
-        all_device_names = set(
-            ["/dev/xvd%s" % (x) for x in string.ascii_lowercase])
-        used_device_names = set()
-        for device in self._instance.block_device_mappings:
-            used_device_names.add(device['DeviceName'])
-
-        return list(all_device_names - used_device_names).pop()
+        # device names for data disks are allocated by this node, only skip
+        # the ones EC2 still reports as used (eg. by the image or by a disk
+        # that is still being detached) and try them again later
+        used_device_names = set(
+            device['DeviceName']
+            for device in self._get_block_device_mappings())
+        for _ in range(0, len(self._device_pool)):
+            device_name = self._device_pool.pop()
+            if device_name not in used_device_names:
+                return device_name
+            self._device_pool.appendleft(device_name)
+        raise Exception(
+            f"No free device name left on instance {self._instance.id}")
 
     def disk_attach(self, name=None, volume=None):
         if name is None and volume is None:
@@ -129,222 +417,399 @@ class Node(NodeBase):
         else:
             name = self._get_vol_name_by_vol(volume)
 
-        if not self._instance:
-            raise Exception("Unable to attach a disk before booting instance")
-        self._instance.wait_until_running()
+        self._wait_until_running()
 
         # wait until volume is available
-        attempts = 0
-        while volume.state != "available":
-            if attempts >= 10:
-                raise Exception(f"Volume {volume} did not become available")
-            time.sleep(5)
-            volume.reload()
-            attempts += 1
-
-        volume.attach_to_instance(
-            Device=self._get_next_device_name(),
-            InstanceId=self._instance.id,
+        volume.meta.client.get_waiter('volume_available').wait(
+            VolumeIds=[volume.id],
+            WaiterConfig={"Delay": 5, "MaxAttempts": 20},
         )
 
+        device = self._get_next_device_name()
+        try:
+            volume.attach_to_instance(
+                Device=device,
+                InstanceId=self._instance.id,
+            )
+        except Exception:
+            self._device_pool.append(device)
+            raise
+
         self._disks[name]['attached'] = True
-        logger.info(f"Volume {name} attached to {self._instance}")
-        self._instance.reload()
+        self._disks[name]['device'] = device
+        logger.info("Volume %s attached to %s", name, self._instance.id)
+        self._bdm_valid = False
 
     def disk_detach(self, name):
         volume = self._disks[name]['volume']
         volume.detach_from_instance()
         self._disks[name]['attached'] = False
-        logger.info(f"Volume {name} detached")
-        if self._instance:
-            self._instance.reload()
+        # EC2 keeps reporting the device while the volume is detaching, so
+        # hand it out again only after all other free names
+        self._device_pool.appendleft(self._disks[name].pop('device'))
+        logger.info("Volume %s detached", name)
+        self._bdm_valid = False
 
     def destroy(self):
         super().destroy()
-        if self._instance:
-            self._instance.terminate()
-            self._instance.wait_until_terminated()
-            for k, v in self._disks.items():
-                _id = v['volume'].id
-                v['volume'].delete()
-                logger.info(f"Deleted volume {k} ({_id})")
+        self._instance.terminate()
+        self._instance.wait_until_terminated()
+        if self._disks:
+            with ThreadPoolExecutor(max_workers=len(self._disks)) as executor:
+                list(executor.map(self._disk_delete, self._disks))
+
+    def _disk_delete(self, name):
+        # runs concurrently, so only use the (thread-safe) client
+        volume_id = self._disks[name]['volume'].id
+        self._ec2.meta.client.delete_volume(VolumeId=volume_id)
+        logger.info("Deleted volume %s (%s)", name, volume_id)
 
 
 class Hardware(HardwareBase):
     def __init__(self, workspace: Workspace):
+        botocore_session = botocore.session.Session()
+        # Resolve the credentials (environment, config files or instance
+        # metadata) once. All clients created from the session reuse them.
+        if botocore_session.get_credentials() is None:
+            raise Exception("Unable to find AWS credentials")
+        self._session = boto3.session.Session(
+            botocore_session=botocore_session)
         super().__init__(workspace)
         self._workspace = workspace
-        self._ec2 = self.get_connection()
+        self._ec2 = self.conn
+        self._batcher = InstanceDescribeBatcher(self._ec2.meta.client)
 
         # basic setup needed for all nodes
-        self._vpc = self._create_vpc()
-        self._gateway = self._create_gateway()
-        self._routetable = self._create_routetable()
-        self._subnet = self._create_subnet()
-        self._security_group = self._create_security_group()
-        self._keypair = self._import_keypair()
+        self._vpc: Any = None
+        self._gateway: Any = None
+        self._routetable: Any = None
+        self._subnet: Any = None
+        self._security_group: Any = None
+        self._keypair: Any = None
+        try:
+            self._create_network()
+        except Exception:
+            # the hardware is not usable (and destroy() will never be called)
+            # so remove whatever got created already
+            logger.error("Setting up the network failed, removing the "
+                         "resources created so far")
+            try:
+                self._delete_network()
+            except Exception:
+                logger.exception("Removing the network resources failed")
+            raise
+
+    def _create_network(self):
+        # Apart from the VPC, the gateway (needed by the routetable) and the
+        # subnet (needed for the association with the routetable) the steps
+        # are independent of each other, so run them concurrently. Every
+        # thread gets its own resource (see _resource()).
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = {
+                '_keypair': executor.submit(
+                    self._import_keypair, self._resource()),
+            }
+            try:
+                self._vpc = self._create_vpc()
+                futures['_gateway'] = executor.submit(
+                    self._create_gateway, self._resource())
+                futures['_subnet'] = executor.submit(
+                    self._create_subnet, self._resource())
+                futures['_security_group'] = executor.submit(
+                    self._create_security_group, self._resource())
+                self._gateway = futures['_gateway'].result()
+                self._routetable = self._create_routetable()
+                self._subnet = futures['_subnet'].result()
+                self._associate_routetable()
+            finally:
+                # keep track of everything that got created, even if another
+                # step failed, so that it can be cleaned up
+                wait(futures.values())
+                for attribute, future in futures.items():
+                    if future.exception() is None:
+                        setattr(self, attribute, future.result())
+        for future in futures.values():
+            future.result()
 
     def get_connection(self):
-        return boto3.resource('ec2')
+        # Every node boots in its own thread and all of them share the client
+        # of this connection (see _resource()), so make sure the connection
+        # pool does not become the bottleneck.
+        # The adaptive retry mode rate limits the client when EC2 starts
+        # throttling (RequestLimitExceeded) instead of hammering the API.
+        # No socket options are needed: botocore already disables Nagle's
+        # algorithm (TCP_NODELAY) on its connections.
+        config = Config(
+            max_pool_connections=max(
+                50, settings.NUMBER_MASTERS + settings.NUMBER_WORKERS),
+            retries={'max_attempts': 10, 'mode': 'adaptive'},
+        )
+        return self._session.resource('ec2', config=config)
+
+    def _resource(self):
+        # boto3 resources are not thread-safe but clients are. Hand out a new
+        # resource for every thread, bound to the one shared client so that
+        # its connection pool and its retry rate limiter cover all threads.
+        return type(self._ec2)(client=self._ec2.meta.client)
 
     def _create_vpc(self):
         vpc = self._ec2.create_vpc(
-            CidrBlock='192.168.100.0/24'
-        )
-        vpc.create_tags(
-            Tags=[{"Key": "Name", "Value":  f"{self.workspace.name}-vpc"}]
+            CidrBlock='192.168.100.0/24',
+            TagSpecifications=_name_tag_specifications(
+                "vpc", f"{self.workspace.name}-vpc"),
         )
-        vpc.wait_until_available()
-        logger.info(f"Created VPC {vpc}")
+        with _delete_on_failure(vpc):
+            vpc.wait_until_available()
+        logger.info("Created VPC %s", vpc.id)
         return vpc
 
-    def _create_gateway(self):
+    def _create_gateway(self, ec2):
         # Create gateway and attach to VPC
-        gateway = self._ec2.create_internet_gateway()
-        gateway.create_tags(
-            Tags=[{"Key": "Name", "Value": f"{self.workspace.name}-gateway"}]
+        gateway = ec2.create_internet_gateway(
+            TagSpecifications=_name_tag_specifications(
+                "internet-gateway", f"{self.workspace.name}-gateway"),
         )
-        self._vpc.attach_internet_gateway(InternetGatewayId=gateway.id)
-        logger.info(f"Created Gateway {gateway} (attached to VPC {self._vpc})")
+        with _delete_on_failure(gateway):
+            gateway.attach_to_vpc(VpcId=self._vpc.id)
+        logger.info("Created Gateway %s (attached to VPC %s)",
+                    gateway.id, self._vpc.id)
         return gateway
 
     def _create_routetable(self):
         # create a route table for VPC and a public route
-        routetable = self._vpc.create_route_table()
-        routetable.create_tags(
-            Tags=[{
-                "Key": "Name",
-                "Value": f"{self.workspace.name}-routetable"
-            }]
+        routetable = self._vpc.create_route_table(
+            TagSpecifications=_name_tag_specifications(
+                "route-table", f"{self.workspace.name}-routetable"),
         )
-        route = routetable.create_route(
-            DestinationCidrBlock='0.0.0.0/0', GatewayId=self._gateway.id)
+        with _delete_on_failure(routetable):
+            route = routetable.create_route(
+                DestinationCidrBlock='0.0.0.0/0', GatewayId=self._gateway.id)
         logger.info(
-            f"Created routetable {routetable} (inside VPC {self._vpc})"
-            f" with route {route}"
+            "Created routetable %s (inside VPC %s) with route %s via %s",
+            routetable.id, self._vpc.id, route.destination_cidr_block,
+            self._gateway.id,
         )
         return routetable
 
-    def _create_subnet(self):
+    def _create_subnet(self, ec2):
         # Create subnet in VPC
-        subnet = self._vpc.create_subnet(
-            CidrBlock='192.168.100.0/25'
+        subnet = ec2.Vpc(self._vpc.id).create_subnet(
+            CidrBlock='192.168.100.0/25',
+            TagSpecifications=_name_tag_specifications(
+                "subnet", f"{self.workspace.name}-subnet"),
         )
-        subnet.create_tags(
-            Tags=[{"Key": "Name", "Value": f"{self.workspace.name}-subnet"}]
-        )
-        subnet.meta.client.modify_subnet_attribute(
-            SubnetId=subnet.id, MapPublicIpOnLaunch={"Value": True}
-        )
-        logger.info(f"Created subnet {subnet} (inside VPC {self._vpc})")
-        self._routetable.associate_with_subnet(SubnetId=subnet.id)
-        logger.info(
-            f"Associated routetable {self._routetable} with subnet {subnet}")
+        with _delete_on_failure(subnet):
+            subnet.meta.client.modify_subnet_attribute(
+                SubnetId=subnet.id, MapPublicIpOnLaunch={"Value": True}
+            )
+        logger.info("Created subnet %s (inside VPC %s)",
+                    subnet.id, self._vpc.id)
         return subnet
 
-    def _create_security_group(self):
+    def _associate_routetable(self):
+        self._routetable.associate_with_subnet(SubnetId=self._subnet.id)
+        logger.info("Associated routetable %s with subnet %s",
+                    self._routetable.id, self._subnet.id)
+
+    def _create_security_group(self, ec2):
         # Create security group
-        security_group = self._vpc.create_security_group(
+        security_group = ec2.Vpc(self._vpc.id).create_security_group(
             GroupName=f"{self.workspace.name}-sg",
             Description='Permissive security group for rookcheck',
+            TagSpecifications=_name_tag_specifications(
+                "security-group", f"{self.workspace.name}-sg"),
         )
-        security_group.create_tags(
-            Tags=[{"Key": "Name", "Value": f"{self.workspace.name}-sg"}])
-        security_group.authorize_ingress(
-            CidrIp='0.0.0.0/0',
-            IpProtocol='-1',
-            FromPort=0,
-            ToPort=65535,
-        )
-        logger.info(
-            f"Created security group {security_group}"
-            f" (inside VPC {self._vpc})"
-        )
+        with _delete_on_failure(security_group):
+            security_group.authorize_ingress(
+                CidrIp='0.0.0.0/0',
+                IpProtocol='-1',
+                FromPort=0,
+                ToPort=65535,
+            )
+        logger.info("Created security group %s (inside VPC %s)",
+                    security_group.id, self._vpc.id)
         return security_group
 
-    def _import_keypair(self):
-        keypair = self._ec2.import_key_pair(
+    def _import_keypair(self, ec2):
+        keypair = ec2.import_key_pair(
             KeyName=f"{self.workspace.name}-key",
             PublicKeyMaterial=self.workspace.public_key
         )
 
-        logger.info(f"Created keypair {keypair}")
+        logger.info("Created keypair %s", keypair.name)
         return keypair
 
+    def _run_instances(self, count: int, **kwargs) -> list:
+        """
+        Launch count identical instances with a single RunInstances call
+        """
+        return self._ec2.create_instances(
+            ImageId=settings.AWS.AMI_IMAGE_ID,
+            InstanceType=settings.AWS.NODE_SIZE,
+            MinCount=count,
+            MaxCount=count,
+            SecurityGroupIds=[
+                self._security_group.id,
+            ],
+            KeyName=self._keypair.name,
+            SubnetId=self._subnet.id,
+            **kwargs,
+        )
+
+    def _terminate_unregistered(self, instances):
+        # Instances which did not end up in a registered node would never be
+        # cleaned up (and keep the network from being deleted)
+        registered = set(node._instance.id for node in self.nodes.values())
+        instance_ids = [
+            instance.id for instance in instances
+            if instance.id not in registered
+        ]
+        if not instance_ids:
+            return
+        client = self._ec2.meta.client
+        client.terminate_instances(InstanceIds=instance_ids)
+        client.get_waiter('instance_terminated').wait(
+            InstanceIds=instance_ids)
+        logger.info("Terminated unused instances %s", ", ".join(instance_ids))
+
+    def _destroy_unregistered_node(self, node: NodeBase):
+        # the node is not part of self.nodes, so destroy() would not clean
+        # it up
+        try:
+            node.destroy()
+        except Exception:
+            logger.exception("Unable to destroy node %s", node.name)
+
     def node_create(self, name: str, role: NodeRole,
-                    tags: List[str]) -> NodeBase:
+                    tags: List[str], instance=None) -> NodeBase:
         super().node_create(name, role, tags)
+        if instance is None:
+            instance = self._run_instances(
+                1, TagSpecifications=_name_tag_specifications(
+                    "instance", name))[0]
+        ec2 = self._resource()
+        # hand the node a copy of the instance bound to its own resource
+        node_instance = ec2.Instance(instance.id)
+        node_instance.meta.data = instance.meta.data
         node = Node(
             name, role, tags,
-            self._ec2, self._subnet, self._security_group, self._keypair,
+            ec2, self._subnet, self._security_group, self._keypair,
+            self._batcher, node_instance,
         )
-        node.boot()
+        try:
+            node.boot()
+        except Exception:
+            self._destroy_unregistered_node(node)
+            raise
         return node
 
     def _node_create_add(self, name: str, role: NodeRole,
-                         tags: List[str]):
-        node = self.node_create(name, role, tags)
-        self.node_add(node)
+                         tags: List[str], instance=None):
+        node = self.node_create(name, role, tags, instance)
+        try:
+            self.node_add(node)
+        except Exception:
+            with self._ansible_create_inventory_lock:
+                self.nodes.pop(node.name, None)
+            self._destroy_unregistered_node(node)
+            raise
 
     def boot_nodes(self, masters: int, workers: int, offset: int = 0):
         super().boot_nodes(masters, workers, offset)
-        threads = []
+        nodes = []
         for m in range(0, masters):
             if m == 0:
                 tags = ['master', 'first_master']
             else:
                 tags = ['master']
             node_name = "%s-master-%d" % (self.workspace.name, m+offset)
-
-            thread = threading.Thread(
-                target=self._node_create_add, args=(node_name, NodeRole.MASTER,
-                                                    tags))
-            threads.append(thread)
-            thread.start()
+            nodes.append((node_name, NodeRole.MASTER, tags))
 
         for m in range(0, workers):
             tags = ['worker']
             node_name = "%s-worker-%d" % (self.workspace.name, m+offset)
-            thread = threading.Thread(
-                target=self._node_create_add, args=(node_name, NodeRole.WORKER,
-                                                    tags))
-            threads.append(thread)
-            thread.start()
+            nodes.append((node_name, NodeRole.WORKER, tags))
+
+        if not nodes:
+            return
 
-        # wait for all threads to finish
-        for t in threads:
-            t.join()
+        # masters and workers use the same launch parameters, so all
+        # instances are requested at once
+        instances = self._run_instances(len(nodes))
+
+        try:
+            with ThreadPoolExecutor(
+                    max_workers=min(32, len(nodes))) as executor:
+                futures = [
+                    executor.submit(self._node_create_add, *node, instance)
+                    for node, instance in zip(nodes, instances)
+                ]
+                try:
+                    # wait for all nodes and raise the first failure
+                    for future in as_completed(futures):
+                        future.result()
+                except Exception:
+                    # do not start booting the nodes which are still queued
+                    for future in futures:
+                        future.cancel()
+                    raise
+        except Exception:
+            self._terminate_unregistered(instances)
+            raise
 
     def destroy(self, skip=False):
         super().destroy(skip=skip)
 
         if skip:
             if self._keypair:
-                logger.warning(f"Leaving keypair {self._keypair}")
+                logger.warning("Leaving keypair %s", self._keypair.name)
             if self._security_group:
-                logger.warning(
-                    f"Leaving security group {self._security_group}")
+                logger.warning("Leaving security group %s",
+                               self._security_group.id)
             if self._subnet:
-                logger.warning(f"Leaving subnet {self._subnet}")
+                logger.warning("Leaving subnet %s", self._subnet.id)
             if self._routetable:
-                logger.warning(f"Leaving routetable {self._routetable}")
+                logger.warning("Leaving routetable %s",
+                               self._routetable.id)
             if self._gateway:
-                logger.warning(f"Leaving gateway {self._gateway}")
+                logger.warning("Leaving gateway %s", self._gateway.id)
             if self._vpc:
-                logger.warning(f"Leaving VPC {self._vpc}")
+                logger.warning("Leaving VPC %s", self._vpc.id)
             return
 
-        self._keypair.delete()
-        logger.info(f"Deleted keypair {self._keypair}")
-        self._security_group.delete()
-        logger.info(f"Deleted security group {self._security_group}")
-        self._subnet.delete()
-        logger.info(f"Deleted subnet {self._subnet}")
-        self._routetable.delete()
-        logger.info(f"Deleted routetable {self._routetable}")
-        self._vpc.detach_internet_gateway(InternetGatewayId=self._gateway.id)
-        logger.info(f"Detached gateway {self._gateway} from VPC {self._vpc}")
-        self._gateway.delete()
-        logger.info(f"Deleted gateway {self._gateway}")
-        self._vpc.delete()
-        logger.info(f"Deleted vpc {self._vpc}")
+        self._delete_network()
+
+    def _delete_network(self):
+        # the keypair does not depend on anything else, so delete it while
+        # the VPC resources are being torn down. Any of the resources might
+        # be missing if the setup failed half way.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            if self._keypair:
+                keypair_deleted = executor.submit(self._delete_keypair)
+            if self._security_group:
+                self._security_group.delete()
+                logger.info("Deleted security group %s",
+                            self._security_group.id)
+            if self._subnet:
+                self._subnet.delete()
+                logger.info("Deleted subnet %s", self._subnet.id)
+            if self._routetable:
+                self._routetable.delete()
+                logger.info("Deleted routetable %s", self._routetable.id)
+            if self._gateway:
+                self._vpc.detach_internet_gateway(
+                    InternetGatewayId=self._gateway.id)
+                logger.info("Detached gateway %s from VPC %s",
+                            self._gateway.id, self._vpc.id)
+                self._gateway.delete()
+                logger.info("Deleted gateway %s", self._gateway.id)
+            if self._vpc:
+                self._vpc.delete()
+                logger.info("Deleted vpc %s", self._vpc.id)
+            if self._keypair:
+                keypair_deleted.result()
+
+    def _delete_keypair(self):
+        # runs concurrently, so only use the (thread-safe) client
+        self._ec2.meta.client.delete_key_pair(KeyName=self._keypair.name)
+        logger.info("Deleted keypair %s", self._keypair.name)
@@ -0,0 +1,388 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+from unittest import mock
+
+import boto3
+from botocore.exceptions import ClientError
+import pytest
+
+from tests.lib.hardware.aws_ec2 import (
+    Hardware, InstanceDescribeBatcher, Node, _instance_running)
+from tests.lib.hardware.node_base import NodeRole
+
+
+class FakeEC2Client:
+    """
+    Minimal stand-in for a boto3 EC2 client recording DescribeInstances calls
+    """
+    def __init__(self, instance_ids, unknown_ids=()):
+        self.instances = {
+            i: {'InstanceId': i, 'State': {'Name': 'pending'}}
+            for i in instance_ids
+        }
+        # ids which make the whole call fail, like EC2 does for ids it does
+        # not know (yet)
+        self.unknown_ids = set(unknown_ids)
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def describe_instances(self, InstanceIds):
+        with self._lock:
+            self.calls.append(sorted(InstanceIds))
+            unknown = self.unknown_ids.intersection(InstanceIds)
+            if unknown:
+                raise ClientError({'Error': {
+                    'Code': 'InvalidInstanceID.NotFound',
+                    'Message': f"The instance IDs {unknown} do not exist",
+                }}, 'DescribeInstances')
+            instances = [dict(self.instances[i]) for i in InstanceIds
+                         if i in self.instances]
+        return {'Reservations': [{'Instances': instances}]}
+
+    def set_state(self, instance_id, state):
+        with self._lock:
+            self.instances[instance_id]['State'] = {'Name': state}
+
+
+def _describe_concurrently(batcher, instance_ids):
+    results = {}
+    barrier = threading.Barrier(len(instance_ids))
+
+    def describe(instance_id):
+        barrier.wait()
+        try:
+            results[instance_id] = batcher.describe(instance_id)
+        except Exception as e:
+            results[instance_id] = e
+
+    threads = [threading.Thread(target=describe, args=(i,))
+               for i in instance_ids]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def test_describe_coalesces_calls():
+    client = FakeEC2Client(['i-1', 'i-2', 'i-3'])
+    batcher = InstanceDescribeBatcher(client, max_delay=0.2)
+
+    results = _describe_concurrently(batcher, ['i-1', 'i-2', 'i-3', 'i-1'])
+
+    assert client.calls == [['i-1', 'i-2', 'i-3']]
+    for instance_id in ['i-1', 'i-2', 'i-3']:
+        assert results[instance_id]['InstanceId'] == instance_id
+
+
+def test_describe_missing_instance_raises():
+    client = FakeEC2Client(['i-1'])
+    batcher = InstanceDescribeBatcher(client, max_delay=0.01)
+
+    with pytest.raises(Exception, match="Instance i-2 not found"):
+        batcher.describe('i-2')
+
+
+def test_describe_failure_only_fails_offending_instance():
+    client = FakeEC2Client(['i-1', 'i-2'], unknown_ids=['i-3'])
+    batcher = InstanceDescribeBatcher(client, max_delay=0.2)
+
+    results = _describe_concurrently(batcher, ['i-1', 'i-2', 'i-3'])
+
+    assert results['i-1']['InstanceId'] == 'i-1'
+    assert results['i-2']['InstanceId'] == 'i-2'
+    assert isinstance(results['i-3'], Exception)
+
+
+def test_describe_failure_does_not_split_on_other_errors():
+    class ThrottledClient(FakeEC2Client):
+        def describe_instances(self, InstanceIds):
+            with self._lock:
+                self.calls.append(sorted(InstanceIds))
+            raise ClientError({'Error': {
+                'Code': 'RequestLimitExceeded',
+                'Message': "Request limit exceeded.",
+            }}, 'DescribeInstances')
+
+    client = ThrottledClient(['i-1', 'i-2'])
+    batcher = InstanceDescribeBatcher(client, max_delay=0.2)
+
+    results = _describe_concurrently(batcher, ['i-1', 'i-2'])
+
+    assert client.calls == [['i-1', 'i-2']]
+    for instance_id in ['i-1', 'i-2']:
+        assert isinstance(results[instance_id], ClientError)
+
+
+def test_describe_times_out():
+    class HangingClient:
+        def describe_instances(self, InstanceIds):
+            threading.Event().wait(1)
+
+    batcher = InstanceDescribeBatcher(
+        HangingClient(), max_delay=0.01, describe_timeout=0.1)
+
+    with pytest.raises(Exception, match="Timed out describing instance"):
+        batcher.describe('i-1')
+
+
+def test_wait_until_wakes_up():
+    client = FakeEC2Client(['i-1', 'i-2'])
+    batcher = InstanceDescribeBatcher(
+        client, max_delay=0.01, poll_interval=0.05)
+    threading.Timer(0.2, client.set_state, args=('i-1', 'running')).start()
+
+    data = batcher.wait_until(
+        'i-1', lambda d: d['State']['Name'] == 'running', timeout=5)
+
+    assert data['State']['Name'] == 'running'
+    assert len(client.calls) > 1
+    assert batcher._watches == {}
+
+
+def test_wait_until_keeps_polling_on_errors():
+    client = FakeEC2Client(['i-1'], unknown_ids=['i-1'])
+    batcher = InstanceDescribeBatcher(
+        client, max_delay=0.01, poll_interval=0.05)
+
+    def instance_appears():
+        with client._lock:
+            client.unknown_ids.clear()
+        client.set_state('i-1', 'running')
+    threading.Timer(0.2, instance_appears).start()
+
+    data = batcher.wait_until(
+        'i-1', lambda d: d['State']['Name'] == 'running', timeout=5)
+
+    assert data['State']['Name'] == 'running'
+
+
+def test_wait_until_gives_up_when_condition_raises():
+    client = FakeEC2Client(['i-1'])
+    client.set_state('i-1', 'terminated')
+    batcher = InstanceDescribeBatcher(
+        client, max_delay=0.01, poll_interval=0.05)
+
+    with pytest.raises(Exception, match="Instance i-1 is terminated"):
+        batcher.wait_until('i-1', _instance_running, timeout=5)
+
+    assert batcher._watches == {}
+
+
+def test_describe_is_not_delayed_by_poll_interval():
+    client = FakeEC2Client(['i-1', 'i-2'])
+    batcher = InstanceDescribeBatcher(
+        client, max_delay=0.01, poll_interval=10)
+    waiter = threading.Thread(
+        target=lambda: pytest.raises(
+            Exception, batcher.wait_until, 'i-2', _instance_running, 1))
+    waiter.start()
+    # let the first poll of the watch happen
+    time.sleep(0.2)
+
+    start = time.monotonic()
+    data = batcher.describe('i-1')
+
+    assert data['InstanceId'] == 'i-1'
+    assert time.monotonic() - start < 1
+    waiter.join()
+
+
+def test_wait_until_times_out():
+    client = FakeEC2Client(['i-1'])
+    batcher = InstanceDescribeBatcher(
+        client, max_delay=0.01, poll_interval=0.05)
+
+    with pytest.raises(Exception, match="Timed out waiting for instance"):
+        batcher.wait_until(
+            'i-1', lambda d: d['State']['Name'] == 'running', timeout=0.2)
+
+    assert batcher._watches == {}
+
+
+class FakeBatcher:
+    """
+    Stand-in for InstanceDescribeBatcher returning fixed data
+    """
+    def __init__(self, data):
+        self.data = data
+        self.describe_calls = 0
+
+    def describe(self, instance_id):
+        self.describe_calls += 1
+        return dict(self.data)
+
+
+def _make_node(block_device_mappings=()):
+    ec2 = boto3.session.Session(
+        region_name='us-east-1', aws_access_key_id='testing',
+        aws_secret_access_key='testing').resource('ec2')
+    data = {
+        'InstanceId': 'i-1',
+        'State': {'Name': 'running'},
+        'BlockDeviceMappings': [
+            {'DeviceName': '/dev/xvda'}
+        ] + [{'DeviceName': d} for d in block_device_mappings],
+    }
+    instance = ec2.Instance('i-1')
+    instance.meta.data = dict(data)
+    batcher = FakeBatcher(data)
+    node = Node('node', NodeRole.WORKER, [], ec2, None, None, None,
+                batcher, instance)
+    return node, batcher
+
+
+def _add_mock_disk(node, name):
+    volume = mock.Mock(id=f"vol-{name}")
+    node._disks[name] = {'volume': volume, 'attached': False}
+    node._disks_by_vol_id[volume.id] = name
+    return volume
+
+
+def test_device_names_skip_used_ones():
+    node, _ = _make_node(block_device_mappings=['/dev/xvdb'])
+
+    assert node._get_next_device_name() == '/dev/xvdc'
+    assert node._get_next_device_name() == '/dev/xvdd'
+    # the used name is only tried again after all other names
+    assert node._device_pool[0] == '/dev/xvdb'
+
+
+def test_detached_device_name_is_reused_last():
+    node, _ = _make_node()
+    _add_mock_disk(node, 'disk1')
+
+    node.disk_attach(name='disk1')
+    assert node._disks['disk1']['device'] == '/dev/xvdb'
+    node.disk_detach('disk1')
+
+    assert node._get_next_device_name() == '/dev/xvdc'
+    assert node._device_pool[0] == '/dev/xvdb'
+
+
+def test_failed_attach_returns_device_name():
+    node, _ = _make_node()
+    volume = _add_mock_disk(node, 'disk1')
+    volume.attach_to_instance.side_effect = Exception("attach failed")
+
+    with pytest.raises(Exception, match="attach failed"):
+        node.disk_attach(name='disk1')
+
+    assert node._get_next_device_name() == '/dev/xvdb'
+
+
+def test_block_device_mappings_cache():
+    node, batcher = _make_node()
+    _add_mock_disk(node, 'disk1')
+
+    node._get_next_device_name()
+    node._get_next_device_name()
+    assert batcher.describe_calls == 1
+
+    # attaching invalidates the cache
+    node.disk_attach(name='disk1')
+    assert batcher.describe_calls == 1
+    node._get_next_device_name()
+    assert batcher.describe_calls == 2
+
+    # and so does detaching
+    node.disk_detach('disk1')
+    node._get_next_device_name()
+    assert batcher.describe_calls == 3
+
+
+def test_disk_create_before_boot_raises():
+    node, _ = _make_node()
+
+    with pytest.raises(Exception, match="until the node is booted"):
+        node.disk_create(10)
+
+
+def _make_hardware():
+    # skip __init__, it would set up the network right away
+    hardware = Hardware.__new__(Hardware)
+    hardware._workspace = mock.Mock()
+    hardware._workspace.name = 'test'
+    hardware._ec2 = mock.Mock()
+    hardware._vpc = None
+    hardware._gateway = None
+    hardware._routetable = None
+    hardware._subnet = None
+    hardware._security_group = None
+    hardware._keypair = None
+    return hardware
+
+
+def test_create_network_keeps_track_of_created_resources():
+    hardware = _make_hardware()
+    vpc, gateway, security_group, keypair = (
+        mock.Mock(), mock.Mock(), mock.Mock(), mock.Mock())
+    with mock.patch.multiple(
+            hardware,
+            _create_vpc=mock.Mock(return_value=vpc),
+            _create_gateway=mock.Mock(return_value=gateway),
+            _create_subnet=mock.Mock(side_effect=Exception("no subnet")),
+            _create_security_group=mock.Mock(return_value=security_group),
+            _import_keypair=mock.Mock(return_value=keypair)):
+        with pytest.raises(Exception, match="no subnet"):
+            hardware._create_network()
+
+    assert hardware._vpc is vpc
+    assert hardware._gateway is gateway
+    assert hardware._security_group is security_group
+    assert hardware._keypair is keypair
+    assert hardware._subnet is None
+    routetable = hardware._routetable
+    assert routetable is vpc.create_route_table.return_value
+
+    hardware._delete_network()
+
+    security_group.delete.assert_called_once_with()
+    routetable.delete.assert_called_once_with()
+    vpc.detach_internet_gateway.assert_called_once_with(
+        InternetGatewayId=gateway.id)
+    gateway.delete.assert_called_once_with()
+    vpc.delete.assert_called_once_with()
+    hardware._ec2.meta.client.delete_key_pair.assert_called_once_with(
+        KeyName=keypair.name)
+
+
+def test_create_subnet_deletes_subnet_on_failure():
+    hardware = _make_hardware()
+    hardware._vpc = mock.Mock()
+    ec2 = mock.Mock()
+    subnet = ec2.Vpc.return_value.create_subnet.return_value
+    subnet.meta.client.modify_subnet_attribute.side_effect = Exception(
+        "modify failed")
+
+    with pytest.raises(Exception, match="modify failed"):
+        hardware._create_subnet(ec2)
+
+    subnet.delete.assert_called_once_with()
+
+
+def test_create_routetable_deletes_routetable_on_failure():
+    hardware = _make_hardware()
+    hardware._vpc = mock.Mock()
+    hardware._gateway = mock.Mock()
+    routetable = hardware._vpc.create_route_table.return_value
+    routetable.create_route.side_effect = Exception("route failed")
+
+    with pytest.raises(Exception, match="route failed"):
+        hardware._create_routetable()
+
+    routetable.delete.assert_called_once_with()